@@ -1,10 +1,17 @@
+import fcntl
+import os
+import secrets
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 from typing import Optional
-from embeddings import bytes_to_emb
+from embeddings import FACE_BACKEND, njit, quantize, stack_quantized
 import numpy as np
 
 DB = 'faces.db'
+# Prefix of the .npy files caching the quantized embedding matrix (see _sync_index)
+INDEX = 'faces_index'
 
 
 def init_db():
@@ -19,7 +26,27 @@ def init_db():
         created_at TEXT
     )
     ''')
+    c.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    # identifies this database file, so an index cache built from a deleted
+    # and recreated faces.db is never mistaken for this one
+    c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('db_token', ?)", (secrets.token_hex(16),))
+    # embeddings from different backends live in different spaces: scoring one
+    # against the other returns confident garbage, so refuse to mix them
+    c.execute("SELECT value FROM meta WHERE key = 'face_backend'")
+    row = c.fetchone()
+    c.execute('SELECT EXISTS(SELECT 1 FROM faces)')
+    has_faces = bool(c.fetchone()[0])
+    # rows from before the backend was recorded were all made with DeepFace
+    stored = row[0] if row else ('deepface' if has_faces else FACE_BACKEND)
+    if has_faces and stored != FACE_BACKEND:
+        conn.close()
+        raise RuntimeError(
+            f"{DB} holds {stored} embeddings but FACE_BACKEND={FACE_BACKEND!r}; "
+            f"set FACE_BACKEND={stored} or re-register the faces into a new database."
+        )
+    c.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('face_backend', ?)", (FACE_BACKEND,))
     conn.commit()
+    _sync_index(conn)
     conn.close()
 
 
@@ -31,27 +58,160 @@ def insert_face(name: str, emb_blob: bytes, image_bytes: bytes):
               (name, emb_blob, image_bytes, now))
     conn.commit()
     rowid = c.lastrowid
+    _sync_index(conn)
     conn.close()
     return rowid
 
 
+# Index of every stored embedding: one contiguous (N, D) int8 matrix plus a
+# float32 scale and the row id per entry, so a lookup is a single int8
+# matrix-vector product. Rows are L2-normalized before quantization. The arrays
+# are persisted as .npy files and memory-mapped read-only, so process start is
+# an mmap rather than a decode of every row, and all workers share the pages.
+# _index is swapped as one (ids, scales, matrix) tuple so concurrent readers
+# always see a consistent snapshot; _index_key is the (db_token, MAX(id)) it
+# was built for.
+_index_lock = threading.Lock()
+_index = None
+_index_key = None
+
+# Rows converted to float32 at a time by the NumPy fallback.
+_SCORE_CHUNK = 4096
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _int8_dot(mat, q):
+        n, d = mat.shape
+        out = np.empty(n, dtype=np.int32)
+        for i in range(n):
+            acc = np.int32(0)
+            for j in range(d):
+                acc += np.int32(mat[i, j]) * np.int32(q[j])
+            out[i] = acc
+        return out
+else:
+    def _int8_dot(mat, q):
+        # int8 products summed over D=512 stay well inside float32's exact range
+        qf = q.astype(np.float32)
+        out = np.empty(mat.shape[0], dtype=np.float32)
+        for s in range(0, mat.shape[0], _SCORE_CHUNK):
+            out[s:s + _SCORE_CHUNK] = mat[s:s + _SCORE_CHUNK].astype(np.float32).dot(qf)
+        return out
+
+
+def _index_path(part: str) -> str:
+    return f'{INDEX}.{part}.npy'
+
+
+@contextmanager
+def _index_file_lock():
+    """Serialize cache rewrites and reads across worker processes."""
+    with open(f'{INDEX}.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _load_index_cache():
+    """Memory-map the cache as (db_token, ids, scales, matrix), or None if absent/partial."""
+    try:
+        with open(f'{INDEX}.token') as f:
+            token = f.read()
+        ids, scales, matrix = (np.asarray(np.load(_index_path(part), mmap_mode='r'))
+                               for part in ('ids', 'scales', 'emb'))
+    except FileNotFoundError:
+        return None
+    if not len(ids) == len(scales) == len(matrix):
+        return None
+    return token, ids, scales, matrix
+
+
+def _save_index_cache(token, ids, scales, matrix):
+    # the token goes last: a rewrite interrupted midway leaves no token, and
+    # the next sync rebuilds instead of trusting mismatched files
+    if os.path.exists(f'{INDEX}.token'):
+        os.remove(f'{INDEX}.token')
+    for part, arr in (('ids', ids), ('scales', scales), ('emb', matrix)):
+        tmp = _index_path(part) + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp, _index_path(part))
+    with open(f'{INDEX}.token.tmp', 'w') as f:
+        f.write(token)
+    os.replace(f'{INDEX}.token.tmp', f'{INDEX}.token')
+
+
+def _sync_index(conn):
+    """Bring the index up to date with rows added by this or any other process."""
+    global _index, _index_key
+    c = conn.cursor()
+    c.execute("SELECT (SELECT value FROM meta WHERE key = 'db_token'), MAX(id) FROM faces")
+    token, max_id = c.fetchone()
+    max_id = max_id or 0
+    if (token, max_id) == _index_key:
+        return
+    with _index_lock, _index_file_lock():
+        if max_id == 0:
+            _index, _index_key = None, (token, 0)
+            return
+        cached = _load_index_cache()
+        if cached is not None and cached[0] == token:
+            _, *cached = cached
+            last_id = int(cached[0][-1]) if len(cached[0]) else 0
+        else:
+            # no cache, or it was built from a different faces.db
+            cached, last_id = None, 0
+        if last_id > max_id:
+            # rows were removed from this database; rebuild
+            cached, last_id = None, 0
+        if last_id < max_id:
+            c.execute('SELECT id, embedding FROM faces WHERE id > ? ORDER BY id', (last_id,))
+            rows = c.fetchall()
+            ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+            matrix = stack_quantized([r[1] for r in rows])
+            # a row's direction is q / ||q|| whatever its stored scale was
+            norms = np.sqrt(np.square(matrix, dtype=np.float32).sum(axis=1))
+            scales = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+            if cached is not None:
+                ids = np.concatenate((cached[0], ids))
+                scales = np.concatenate((cached[1], scales))
+                matrix = np.concatenate((cached[2], matrix))
+            _save_index_cache(token, ids, scales, matrix)
+            cached = _load_index_cache()[1:]
+        _index, _index_key = tuple(cached), (token, max_id)
+
+
 def find_best_match(emb: np.ndarray, top_k=1, threshold=0.4) -> Optional[dict]:
     # emb expected normalized float32
     conn = sqlite3.connect(DB)
-    c = conn.cursor()
-    c.execute('SELECT id, name, embedding FROM faces')
+    _sync_index(conn)
+    index = _index
+    if index is None:
+        conn.close()
+        return None
+    ids, scales, matrix = index
+    # Score q_probe . q_row / (||q_probe|| ||q_row||): the same 1/||q|| scaling
+    # the rows use, so this is a true cosine of the quantized vectors.
+    q, _ = quantize(emb)
+    q_norm = float(np.sqrt(np.square(q, dtype=np.float64).sum()))
+    if q_norm == 0.0:
+        conn.close()
+        return None
+    acc = _int8_dot(matrix, q)
+    scores = acc * scales.astype(np.float64) / q_norm
+    i = int(np.argmax(scores))
+    # rounding in the float32 row scales can nudge an identical vector past 1
+    score = min(float(scores[i]), 1.0)
     best = None
-    best_score = -1.0
-    for row in c.fetchall():
-        id_, name, emb_blob = row
-        db_emb = bytes_to_emb(emb_blob)
-        # ensure normalized
-        # cosine similarity
-        score = float(np.dot(emb / np.linalg.norm(emb), db_emb / np.linalg.norm(db_emb)))
-        if score > best_score:
-            best_score = score
-            best = {'id': id_, 'name': name, 'score': score}
+    if score >= threshold:
+        id_ = int(ids[i])
+        c = conn.cursor()
+        c.execute('SELECT name FROM faces WHERE id = ?', (id_,))
+        row = c.fetchone()
+        if row is not None:
+            best = {'id': id_, 'name': row[0], 'score': score}
     conn.close()
-    if best and best['score'] >= threshold:
-        return best
-    return None
\ No newline at end of file
+    return best
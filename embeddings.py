@@ -1,13 +1,38 @@
 import io
+import logging
+import math
+import os
+import struct
 import zlib
 import numpy as np
 from PIL import Image
-import tempfile
-import os
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; callers (here and db.py) fall back to NumPy
+    njit = None
+
+logger = logging.getLogger(__name__)
+
+# Longest image side handed to the detector. Phone photos are 3-4x this; the
+# face crop the model actually sees is 112-160 px, so the rest is bandwidth.
+MAX_IMAGE_SIDE = int(os.environ.get("MAX_IMAGE_SIDE", 1024))
+
+# Face model backend: "deepface" (ArcFace via TensorFlow) or "insightface"
+# (buffalo_l via ONNX Runtime). The two produce different embedding spaces, so
+# switching requires re-registering the stored faces; db.init_db enforces it.
+FACE_BACKEND = os.environ.get("FACE_BACKEND", "deepface").lower()
+
+# Embedding calls that may run at once (main.py's thread pool size); native
+# thread pools are sized so these calls together use each core once.
+EMBED_WORKERS = int(os.environ.get("EMBED_WORKERS", 2))
 
 _deepface_model = None
+_insightface_app = None
+_turbojpeg = None
 _deepface_backend_name = "ArcFace"  
 
+
 def _init_deepface():
     global _deepface_model
     if _deepface_model is None:
@@ -22,60 +47,248 @@ def _init_deepface():
     return _deepface_model
 
 
-def get_embedding_from_bytes(image_bytes: bytes) -> np.ndarray:
-    from deepface import DeepFace
+def _optimize_recognizer_session(rec):
+    """Rebuild the ArcFace ONNX session for batch-1 CPU inference.
+
+    Every graph optimization is enabled and ops run sequentially. Intra-op
+    threads are split across EMBED_WORKERS so concurrent requests don't
+    oversubscribe the CPU.
+    """
+    import onnxruntime as ort
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    opts.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    opts.intra_op_num_threads = max(1, (os.cpu_count() or 1) // EMBED_WORKERS)
+    rec.session = ort.InferenceSession(rec.model_file, sess_options=opts,
+                                       providers=["CPUExecutionProvider"])
+
+
+def _init_insightface():
+    global _insightface_app
+    if _insightface_app is None:
+        try:
+            from insightface.app import FaceAnalysis
+            import onnxruntime  # imported here so a missing install gets the message below
+        except Exception as e:
+            raise RuntimeError(
+                "InsightFace is not installed. Install with `pip install insightface onnxruntime`."
+            ) from e
+        app = FaceAnalysis(name="buffalo_l", allowed_modules=["detection", "recognition"],
+                           providers=["CPUExecutionProvider"])
+        app.prepare(ctx_id=-1)
+        _optimize_recognizer_session(app.models["recognition"])
+        _insightface_app = app
+    return _insightface_app
+
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _l2norm_1d(x):
+        """L2-normalize a 1-D float32 vector in place; returns its original norm."""
+        s = 0.0
+        for i in range(x.shape[0]):
+            s += x[i] * x[i]
+        norm = math.sqrt(s)
+        if norm > 0.0:
+            inv = 1.0 / norm
+            for i in range(x.shape[0]):
+                x[i] *= inv
+        return norm
+
+    @njit(cache=True, fastmath=True)
+    def _l2norm_2d(x):
+        """L2-normalize each row of a 2-D float32 array in place; returns the row norms."""
+        norms = np.empty(x.shape[0], dtype=np.float32)
+        for r in range(x.shape[0]):
+            norms[r] = _l2norm_1d(x[r])
+        return norms
+else:
+    def _l2norm_1d(x):
+        """L2-normalize a 1-D float32 vector in place; returns its original norm."""
+        norm = float(np.sqrt(x @ x))
+        if norm > 0.0:
+            x *= 1.0 / norm
+        return norm
+
+    def _l2norm_2d(x):
+        """L2-normalize each row of a 2-D float32 array in place; returns the row norms."""
+        norms = np.linalg.norm(x, axis=1).astype(np.float32)
+        np.divide(x, norms[:, None], out=x, where=norms[:, None] > 0)
+        return norms
+
+
+def _pil_to_numpy(img: Image.Image) -> np.ndarray:
+    """Copy a PIL image into a (H, W, C) uint8 array in a single raw-encoder pass.
+
+    np.array(img) goes through Image.tobytes(), which encodes in MAXBLOCK-sized
+    chunks and then joins them: two full copies of the pixel data.
+    """
+    img.load()
+    shape = (img.height, img.width, len(img.getbands()))
+    encoder = Image._getencoder(img.mode, "raw", img.mode)
+    encoder.setimage(img.im, (0, 0) + img.size)
+    _, errcode, data = encoder.encode(shape[0] * shape[1] * shape[2])
+    if errcode != 1:
+        # encoder did not finish in one call (unexpected mode/layout)
+        return np.asarray(img)
+    return np.frombuffer(data, dtype=np.uint8).reshape(shape)
+
+
+def _get_turbojpeg():
+    """Shared TurboJPEG decoder, or None when PyTurboJPEG/libturbojpeg is missing."""
+    global _turbojpeg
+    if _turbojpeg is None:
+        try:
+            from turbojpeg import TurboJPEG
+            _turbojpeg = TurboJPEG()
+        except Exception as e:
+            # cached as False, so this is logged once per process
+            logger.warning("libjpeg-turbo unavailable, decoding JPEGs with Pillow: %s", e)
+            _turbojpeg = False
+    return _turbojpeg or None
+
+
+def _jpeg_scaling_factor(tj, side: int):
+    """Strongest libjpeg-turbo DCT downscale that keeps `side` >= MAX_IMAGE_SIDE."""
+    fits = [f for f in tj.scaling_factors if f[0] <= f[1] and side * f[0] >= MAX_IMAGE_SIDE * f[1]]
+    return min(fits, key=lambda f: f[0] / f[1]) if fits else None
+
+
+def _fit_max_side(img: np.ndarray) -> np.ndarray:
+    """Area-downscale an (H, W, C) array so its longest side is at most MAX_IMAGE_SIDE."""
+    height, width = img.shape[:2]
+    side = max(height, width)
+    if side <= MAX_IMAGE_SIDE:
+        return img
+    import cv2
+    ratio = MAX_IMAGE_SIDE / side
+    size = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+    return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+def _decode_image(image_bytes: bytes) -> np.ndarray:
+    """Decode image bytes to a (H, W, 3) uint8 RGB array, longest side <= MAX_IMAGE_SIDE."""
+    tj = _get_turbojpeg() if image_bytes[:3] == b"\xff\xd8\xff" else None
+    if tj is not None:
+        try:
+            from turbojpeg import TJPF_RGB
+            width, height, _, _ = tj.decode_header(image_bytes)
+            # DCT scaling gets within one step of the cap almost for free; the
+            # area resize finishes the job on the already-small image
+            img = tj.decode(image_bytes, pixel_format=TJPF_RGB,
+                            scaling_factor=_jpeg_scaling_factor(tj, max(width, height)))
+        except Exception:
+            pass  # e.g. CMYK or truncated JPEG; let Pillow have a go
+        else:
+            return _fit_max_side(img)
+    img = Image.open(io.BytesIO(image_bytes))
+    # before convert(): for JPEGs this lets Pillow decode at reduced DCT scale
+    img.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.Resampling.BILINEAR)
+    return _pil_to_numpy(img.convert("RGB"))
+
+
+def _deepface_embed(image_bytes: bytes) -> np.ndarray:
     model = _init_deepface()
-    img = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    from deepface import DeepFace
+    img_np = _decode_image(image_bytes)
     rep = None
     try:
         rep = DeepFace.represent(
-            img_path=np.array(img),
+            img_path=img_np,
             model_name=_deepface_backend_name,
             # model=model, # type: ignore
             enforce_detection=True
         )
     except Exception as e:
-        print(f"[WARN] Array input failed, falling back to temp file: {e}")
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmp_file:
-            img.save(tmp_file, format="JPEG")
-            tmp_path = tmp_file.name
-        try:
-            rep = DeepFace.represent(
-                img_path=tmp_path,
-                model_name=_deepface_backend_name,
-                # model=model, # type: ignore
-                enforce_detection=True
-            )
-        finally:
-            if os.path.exists(tmp_path):
-                os.remove(tmp_path)
+        # A file path used to work here only because DeepFace reads it with
+        # cv2.imread: a contiguous BGR uint8 array is the same input, minus
+        # the JPEG re-encode/decode round trip through disk.
+        logger.warning("RGB array input failed, retrying as BGR: %s", e)
+        rep = DeepFace.represent(
+            img_path=np.ascontiguousarray(img_np[:, :, ::-1]),
+            model_name=_deepface_backend_name,
+            # model=model, # type: ignore
+            enforce_detection=True
+        )
 
     # Parse embedding
-    emb = None
-    if not rep:
-        raise RuntimeError("DeepFace did not return an embedding.")
     if isinstance(rep, list) and len(rep) > 0 and "embedding" in rep[0]:
-        emb = np.array(rep[0]["embedding"], dtype=np.float32) # type: ignore
-    elif isinstance(rep, dict) and "embedding" in rep:
-        emb = np.array(rep["embedding"], dtype=np.float32) # type: ignore
-    if emb is None:
-        raise RuntimeError("DeepFace did not return an embedding.")
-    norm = np.linalg.norm(emb)
-    if norm == 0:
-        raise RuntimeError("Zero-norm embedding from DeepFace.")
-    return (emb / norm).astype(np.float32)
+        return np.asarray(rep[0]["embedding"], dtype=np.float32) # type: ignore
+    if isinstance(rep, dict) and "embedding" in rep:
+        return np.asarray(rep["embedding"], dtype=np.float32) # type: ignore
+    raise RuntimeError("DeepFace did not return an embedding.")
+
+
+def _insightface_embed(image_bytes: bytes) -> np.ndarray:
+    app = _init_insightface()
+    # InsightFace follows the OpenCV convention of BGR input
+    img_bgr = np.ascontiguousarray(_decode_image(image_bytes)[:, :, ::-1])
+    faces = app.get(img_bgr)
+    if not faces:
+        raise RuntimeError("No face detected in image.")
+    return np.asarray(faces[0].embedding, dtype=np.float32)
+
+
+_BACKENDS = {
+    "deepface": (_deepface_embed, _init_deepface),
+    "insightface": (_insightface_embed, _init_insightface),
+}
+if FACE_BACKEND not in _BACKENDS:
+    raise RuntimeError(f"Unknown FACE_BACKEND {FACE_BACKEND!r}; expected one of {sorted(_BACKENDS)}.")
+_embed, warm_up = _BACKENDS[FACE_BACKEND]
+
+
+def get_embedding_from_bytes(image_bytes: bytes) -> np.ndarray:
+    """L2-normalized float32 embedding of the first face in the image."""
+    emb = _embed(image_bytes)
+    if _l2norm_1d(emb) == 0:
+        raise RuntimeError(f"Zero-norm embedding from {FACE_BACKEND}.")
+    return emb
+
+
+# 1-byte header prefixed to every embedding blob. Rows written before the
+# header existed are bare float16 zlib streams (first byte 0x78) and are still
+# decoded. 0x01/0x02 were never written by a release; don't reuse them.
+_EMB_INT8 = b"\x03"
+
+
+def quantize(emb: np.ndarray):
+    """Symmetric int8 quantization with a single float32 scale per vector."""
+    scale = float(np.max(np.abs(emb))) / 127.0
+    if scale == 0.0:
+        return np.zeros(emb.shape, dtype=np.int8), np.float32(0.0)
+    q = np.round(emb / scale).astype(np.int8)
+    return q, np.float32(scale)
 
 
 def emb_to_bytes(emb: np.ndarray) -> bytes:
-    """Compress and convert embedding to bytes for DB storage (float16 + zlib)."""
-    f16 = emb.astype(np.float16)
-    raw = f16.tobytes()
-    compressed = zlib.compress(raw, level=6)
-    return compressed
+    """Convert embedding to bytes for DB storage (int8 + float32 scale, 1-byte header)."""
+    q, scale = quantize(emb)
+    return _EMB_INT8 + struct.pack("<f", scale) + q.tobytes()
+
+
+def stack_quantized(blobs) -> np.ndarray:
+    """Stack stored embeddings into an (N, D) int8 matrix of quantized values.
+
+    Per-vector scales are dropped: callers only scoring directions rescale each
+    row by its own norm. When every blob is int8 they are sliced out of one
+    joined buffer; older formats are quantized row by row.
+    """
+    size = len(blobs[0])
+    if all(len(b) == size and b[:1] == _EMB_INT8 for b in blobs):
+        buf = np.frombuffer(b"".join(blobs), dtype=np.int8).reshape(len(blobs), size)
+        return np.ascontiguousarray(buf[:, 5:])
+    return np.stack([
+        np.frombuffer(b, dtype=np.int8, offset=5) if b[:1] == _EMB_INT8 else quantize(bytes_to_emb(b))[0]
+        for b in blobs
+    ])
 
 
 def bytes_to_emb(blob: bytes) -> np.ndarray:
-    """Decompress bytes back to float32 numpy array."""
-    raw = zlib.decompress(blob)
-    arr = np.frombuffer(raw, dtype=np.float16)
-    return arr.astype(np.float32)
\ No newline at end of file
+    """Convert stored bytes back to float32 numpy array."""
+    tag = blob[:1]
+    if tag == _EMB_INT8:
+        (scale,) = struct.unpack_from("<f", blob, 1)
+        return np.frombuffer(blob, dtype=np.int8, offset=5).astype(np.float32) * np.float32(scale)
+    # legacy headerless float16 + zlib
+    return np.frombuffer(zlib.decompress(blob), dtype=np.float16).astype(np.float32)
@@ -1,19 +1,47 @@
 # main.py
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException , Body
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException , Header, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 import os
-import base64
-from embeddings import get_embedding_from_bytes, emb_to_bytes, bytes_to_emb
+import asyncio
+from urllib.parse import unquote
+import logging
+try:
+    import pybase64 as base64  # SIMD decoder, same API as the stdlib module
+except ImportError:
+    import base64
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from embeddings import get_embedding_from_bytes, emb_to_bytes, bytes_to_emb, warm_up, EMBED_WORKERS
 from db import init_db, insert_face, find_best_match
-from pydantic import BaseModel
+from typing import Annotated, Optional
+from pydantic import BaseModel, BeforeValidator, ValidationError, WithJsonSchema
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
+logger = logging.getLogger(__name__)
+
+# Embedding is CPU-bound model inference that releases the GIL inside the
+# native kernels; run it off the event loop so other requests keep flowing.
+_embed_pool = ThreadPoolExecutor(max_workers=EMBED_WORKERS)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load the face model before the worker starts accepting requests."""
+    try:
+        warm_up()
+    except Exception as e:
+        # keep serving; the first request will retry and report the error
+        logger.warning("Model warm-up failed -> %s", e)
+    yield
 
 
 app = FastAPI(
     title="Face Recognition API",
     description="Face registration and verification system",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -27,12 +55,72 @@ app.add_middleware(
 
 init_db()
 
+
+async def _embed(image_bytes: bytes):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_embed_pool, get_embedding_from_bytes, image_bytes)
+
+
+def _b64decode(value):
+    # b64decode raises TypeError on other types, which pydantic would not
+    # turn into a validation error
+    if not isinstance(value, (str, bytes)):
+        raise ValueError("expected a base64-encoded string")
+    return base64.b64decode(value)
+
+
+# Base64 image field decoded during validation, so handlers get bytes directly.
+Base64Image = Annotated[
+    bytes,
+    BeforeValidator(_b64decode),
+    WithJsonSchema({"type": "string", "contentEncoding": "base64"}),
+]
+
+
 class RegisterPayload(BaseModel):
     name: str
-    image: str
+    image: Base64Image
 
 class VerifyPayload(BaseModel):
-    image_base64: str
+    image_base64: Base64Image
+
+
+# Response models let FastAPI serialize straight to JSON bytes in pydantic-core.
+class RegisterResponse(BaseModel):
+    status: str
+    message: str
+    id: int
+
+class MatchInfo(BaseModel):
+    id: int
+    name: str
+    confidence: float
+
+class VerifyResponse(BaseModel):
+    status: str
+    match_found: bool
+    match: Optional[MatchInfo]
+    message: Optional[str] = None
+
+
+def _image_body(model) -> dict:
+    """OpenAPI request body: raw image bytes, or the deprecated base64 JSON form."""
+    return {"requestBody": {"required": True, "content": {
+        "application/octet-stream": {"schema": {"type": "string", "format": "binary"}},
+        "application/json": {"schema": model.model_json_schema()},
+    }}}
+
+
+def _is_json(request: Request) -> bool:
+    return request.headers.get("content-type", "").lower().startswith("application/json")
+
+
+async def _read_json_payload(request: Request, model):
+    """Parse a deprecated base64 JSON body, reporting errors like FastAPI's own validation."""
+    try:
+        return model.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError([{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)])
 
 @app.get("/")
 async def root():
@@ -46,96 +134,110 @@ async def root():
         }
     }
 
-@app.post('/register')
-async def register(payload: RegisterPayload = Body(...)):
-    try:
+@app.post('/register', response_model=RegisterResponse, openapi_extra=_image_body(RegisterPayload))
+async def register(request: Request, x_name: Optional[str] = Header(None, description="Percent-encoded UTF-8 name")):
+    """Register the face in the raw image body under the name in the X-Name header.
+
+    X-Name is percent-encoded UTF-8 (e.g. `Jos%C3%A9`), since header values are
+    latin-1 on the wire. A JSON body of {"name", "image": <base64>} is still
+    accepted but deprecated.
+    """
+    if _is_json(request):
+        payload = await _read_json_payload(request, RegisterPayload)
+        name, image_bytes = payload.name, payload.image
+    else:
+        if not x_name:
+            raise HTTPException(status_code=400, detail="Missing X-Name header")
         try:
-            print("DEBUG: Decoding image...")
-            image_bytes = base64.b64decode(payload.image)
-            print(f"DEBUG: Image decoded, size={len(image_bytes)}")
-        except Exception as decode_error:
-            print(f"ERROR: Base64 decode failed -> {decode_error}")
-            raise HTTPException(status_code=400, detail="Invalid base64 image")
+            name = unquote(x_name, errors="strict")
+        except UnicodeDecodeError:
+            raise HTTPException(status_code=400, detail="X-Name must be percent-encoded UTF-8")
+        image_bytes = await request.body()
 
+    try:
         if len(image_bytes) == 0:
-            print("WARNING: Empty image data after decoding")
+            logger.warning("Empty image data after decoding")
             raise HTTPException(status_code=400, detail="Empty image data")
 
-        print("DEBUG: Getting embedding...")
-        emb = get_embedding_from_bytes(image_bytes)
-        print(f"DEBUG: Embedding length={len(emb)}")
-
-        print("DEBUG: Converting embedding to blob...")
+        emb = await _embed(image_bytes)
         emb_blob = emb_to_bytes(emb)
-        print(f"DEBUG: Blob size={len(emb_blob)}")
+        logger.debug("Image size=%d, embedding length=%d, blob size=%d",
+                     len(image_bytes), len(emb), len(emb_blob))
 
-        print(f"DEBUG: Inserting face record for {payload.name}...")
-        row_id = insert_face(payload.name, emb_blob, image_bytes)
-        print(f"INFO: Insert successful, row_id={row_id}")
+        # the insert also rewrites the index cache: keep it off the event loop
+        row_id = await asyncio.to_thread(insert_face, name, emb_blob, image_bytes)
+        logger.info("Registered %s, row_id=%s", name, row_id)
 
-        return JSONResponse({
+        return {
             'status': 'success',
-            'message': f'Face registered successfully for {payload.name}',
+            'message': f'Face registered successfully for {name}',
             'id': row_id
-        })
+        }
 
-    except HTTPException as http_err:
-        print(f"HTTPException: {http_err.detail}")
+    except HTTPException:
         raise
     except Exception as e:
-        print(f"EXCEPTION: Unexpected error -> {e}")
+        logger.exception("Unexpected error during registration")
         raise HTTPException(status_code=500, detail=f"Registration failed: {str(e)}")
 
 
-@app.post('/verify')
-async def verify(payload: VerifyPayload = Body(...)):
-    try:
-        print("DEBUG: Starting verification...")
+@app.post('/verify', response_model=VerifyResponse, response_model_exclude_unset=True,
+          openapi_extra=_image_body(VerifyPayload))
+async def verify(request: Request):
+    """Find the registered face that best matches the raw image body.
 
-        print("DEBUG: Decoding image from base64...")
-        image_bytes = base64.b64decode(payload.image_base64)
-        print(f"DEBUG: Image decoded, size={len(image_bytes)}")
+    A JSON body of {"image_base64": <base64>} is still accepted but deprecated.
+    """
+    if _is_json(request):
+        image_bytes = (await _read_json_payload(request, VerifyPayload)).image_base64
+    else:
+        image_bytes = await request.body()
 
+    try:
         if len(image_bytes) == 0:
-            print("WARNING: Empty image data after decoding")
+            logger.warning("Empty image data after decoding")
             raise HTTPException(status_code=400, detail="Empty image data")
 
-        print("DEBUG: Extracting embedding from image bytes...")
-        emb = get_embedding_from_bytes(image_bytes)
-        print(f"DEBUG: Embedding extracted, length={len(emb)}")
-
-        print("DEBUG: Searching for best match in database...")
-        match = find_best_match(emb)
+        emb = await _embed(image_bytes)
+        match = await asyncio.to_thread(find_best_match, emb)
 
         if match:
-            print(f"INFO: Match found -> id={match['id']}, name={match['name']}, score={match['score']}")
-            return JSONResponse({
+            logger.debug("Match found -> id=%s, name=%s, score=%s", match['id'], match['name'], match['score'])
+            return {
                 'status': 'success',
                 'match_found': True,
                 'match': {
                     'id': match['id'],
                     'name': match['name'],
-                    'confidence': round(match['score'], 4)
+                    'confidence': match['score']
                 }
-            })
+            }
         else:
-            print("INFO: No matching face found")
-            return JSONResponse({
+            logger.debug("No matching face found")
+            return {
                 'status': 'success',
                 'match_found': False,
                 'match': None,
                 'message': 'No matching face found'
-            })
+            }
 
-    except HTTPException as http_err:
-        print(f"HTTPException: {http_err.detail}")
+    except HTTPException:
         raise
     except Exception as e:
-        print(f"EXCEPTION: Unexpected error during verification -> {e}")
+        logger.exception("Unexpected error during verification")
         raise HTTPException(status_code=500, detail=f"Verification failed: {str(e)}")
 
 
-# # For Render deployment
-# if __name__ == '__main__':
-#     port = int(os.environ.get('PORT', 8000))
-#     uvicorn.run("main:app", host="0.0.0.0", port=port, reload=False)
+# For Render deployment
+if __name__ == '__main__':
+    port = int(os.environ.get('PORT', 8000))
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        reload=False,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.environ.get('WEB_CONCURRENCY', 1)),
+        access_log=False,
+    )
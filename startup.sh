@@ -9,4 +9,4 @@ apt-get install -y libgl1 libglib2.0-0
 
 # Start the FastAPI app
 # Replace main:app with your module and app name
-uvicorn main:app --host 0.0.0.0 --port 8000
+uvicorn main:app --host 0.0.0.0 --port 8000 --loop uvloop --http httptools --no-access-log